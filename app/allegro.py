@@ -1,12 +1,15 @@
 from __future__ import annotations
 
+import asyncio
 import base64
 import logging
 from datetime import datetime, timedelta, timezone
+from email.utils import parsedate_to_datetime
 from pathlib import Path
 from typing import Any, Dict, Optional
 
 import httpx
+import orjson
 from dotenv import set_key
 
 from .config import Settings
@@ -22,12 +25,58 @@ logger = logging.getLogger(__name__)
 PROJECT_ROOT = Path(__file__).resolve().parent.parent
 ENV_FILE = PROJECT_ROOT / ".env"
 
+# Window before expiry in which the token is still served but refreshed
+# in the background, so callers never wait on the OAuth round-trip.
+TOKEN_REFRESH_MARGIN = timedelta(minutes=5)
+
+RATE_LIMIT_STATUSES = (429, 503)
+
+# Upper bound on how long a single Retry-After hint may stall a request. The
+# wait happens inside the request, so the caller keeps its concurrency slot.
+MAX_RETRY_AFTER_SECONDS = 300
+# Token refreshes hold the refresh lock that every expired-token caller waits on
+TOKEN_MAX_RETRY_AFTER_SECONDS = 10
+
+TOKEN_FRESH = "fresh"
+TOKEN_STALE = "stale"
+TOKEN_EXPIRED = "expired"
+
+
+def is_rate_limited(exc: BaseException) -> bool:
+    """Whether exc is an Allegro 429/503 response."""
+    return (
+        isinstance(exc, httpx.HTTPStatusError)
+        and exc.response.status_code in RATE_LIMIT_STATUSES
+    )
+
+
+def _retry_delay(r: httpx.Response, max_wait: float) -> Optional[float]:
+    """Seconds to wait according to Retry-After or X-RateLimit-Reset."""
+    value = r.headers.get("Retry-After") or r.headers.get("X-RateLimit-Reset")
+    if not value:
+        return None
+    try:
+        delay = float(value)
+    except ValueError:
+        try:
+            when = parsedate_to_datetime(value)
+        except (TypeError, ValueError):
+            return None
+        if when.tzinfo is None:
+            # "-0000" dates parse as naive; HTTP dates are always UTC
+            when = when.replace(tzinfo=timezone.utc)
+        delay = (when - datetime.now(timezone.utc)).total_seconds()
+    return min(max(delay, 0.0), max_wait)
+
 
 class AllegroClient:
     def __init__(self, settings: Settings) -> None:
         self.settings = settings
         self._token: Optional[str] = None
+        self._bearer: str = ""
         self._token_expiry: datetime = datetime.now(timezone.utc)
+        self._refresh_lock = asyncio.Lock()
+        self._refresh_task: Optional[asyncio.Task] = None
 
         if settings.environment.lower().startswith("sandbox"):
             self.api_base = "https://api.allegro.pl.allegrosandbox.pl"
@@ -36,73 +85,186 @@ class AllegroClient:
             self.api_base = "https://api.allegro.pl"
             self.oauth_base = "https://allegro.pl/auth/oauth"
 
+        self._basic_auth = (
+            "Basic "
+            + base64.b64encode(
+                f"{settings.client_id}:{settings.client_secret}".encode()
+            ).decode()
+        )
+        public_type = "application/vnd.allegro.public.v1+json"
+        beta_type = "application/vnd.allegro.beta.v1+json"
+        self._hdr_public = {"Accept": public_type, "Content-Type": public_type}
+        self._hdr_beta = {"Accept": beta_type, "Content-Type": beta_type}
+
+        # Shared connection pool so polls reuse keep-alive connections instead
+        # of paying a TCP+TLS handshake on every request. HTTP/2 lets concurrent
+        # requests multiplex over a single connection.
+        self._http = httpx.AsyncClient(
+            base_url=self.api_base,
+            timeout=30,
+            http2=True,
+            limits=httpx.Limits(
+                max_keepalive_connections=10, max_connections=20, keepalive_expiry=60
+            ),
+        )
+        self._http_version_logged = False
+
+        # ETags of the last list responses, sent back as If-None-Match so an
+        # unchanged inbox costs a bodiless 304 instead of a full listing.
+        self._threads_etag: Optional[str] = None
+        self._issues_etag: Optional[str] = None
+
+    async def aclose(self) -> None:
+        # Stop an in-flight background refresh before its connection goes away
+        if self._refresh_task and not self._refresh_task.done():
+            self._refresh_task.cancel()
+            await asyncio.gather(self._refresh_task, return_exceptions=True)
+        await self._http.aclose()
+
+    def _token_state(self) -> str:
+        if not self._token:
+            return TOKEN_EXPIRED
+        now = datetime.now(timezone.utc)
+        if now < self._token_expiry - TOKEN_REFRESH_MARGIN:
+            return TOKEN_FRESH
+        if now < self._token_expiry:
+            return TOKEN_STALE
+        return TOKEN_EXPIRED
+
+    def token_refresh_delay(self) -> float:
+        """Seconds until the current token should be proactively refreshed."""
+        due = self._token_expiry - TOKEN_REFRESH_MARGIN
+        return max(30.0, (due - datetime.now(timezone.utc)).total_seconds())
+
     async def _ensure_token(self) -> str:
-        if self._token and datetime.now(timezone.utc) < self._token_expiry:
+        state = self._token_state()
+        if state == TOKEN_FRESH:
             return self._token
 
-        basic = base64.b64encode(
-            f"{self.settings.client_id}:{self.settings.client_secret}".encode()
-        ).decode()
+        if state == TOKEN_STALE:
+            if self._refresh_task is None or self._refresh_task.done():
+                self._refresh_task = asyncio.create_task(self._background_refresh())
+            return self._token
+
+        await self.refresh_access_token()
+        assert self._token, "Failed to obtain access token"
+        return self._token
+
+    async def refresh_access_token(self) -> None:
+        """Refresh the access token unless it is still fresh."""
+        async with self._refresh_lock:
+            if self._token_state() != TOKEN_FRESH:
+                await self._do_refresh()
+
+    async def _background_refresh(self) -> None:
+        try:
+            await self.refresh_access_token()
+        except Exception:
+            logger.exception("_background_refresh: Token refresh failed")
+
+    async def _do_refresh(self) -> None:
         headers = {
-            "Authorization": f"Basic {basic}",
+            "Authorization": self._basic_auth,
             "Content-Type": "application/x-www-form-urlencoded",
         }
         data = {
             "grant_type": "refresh_token",
             "refresh_token": self.settings.refresh_token,
         }
-        async with httpx.AsyncClient(timeout=30) as client:
-            r = await client.post(
-                f"{self.oauth_base}/token", headers=headers, data=data
-            )
+        r = await self._request(
+            "POST",
+            f"{self.oauth_base}/token",
+            max_wait=TOKEN_MAX_RETRY_AFTER_SECONDS,
+            headers=headers,
+            data=data,
+        )
+        payload = self._json(r)
+        token = payload["access_token"]
+        # Refresh a bit earlier than exact expiry
+        expiry = datetime.now(timezone.utc) + timedelta(
+            seconds=int(payload.get("expires_in", 3600)) - 120
+        )
+        # No await between these, so concurrent callers never see a mix
+        self._token = token
+        self._bearer = f"Bearer {token}"
+        self._token_expiry = expiry
+
+        # Update refresh token if present in response
+        new_refresh_token = payload.get("refresh_token")
+        if new_refresh_token and new_refresh_token != self.settings.refresh_token:
+            self.settings.refresh_token = new_refresh_token
+            # Persist to .env if possible
+            try:
+                set_key(str(ENV_FILE), "ALLEGRO_REFRESH_TOKEN", new_refresh_token)
+                logger.info("_do_refresh: Updated refresh token in .env file")
+            except Exception as e:
+                logger.warning(
+                    "_do_refresh: Failed to update refresh token in .env: %s", e
+                )
+
+        logger.info("_do_refresh: Obtained new access token")
+
+    async def _request(
+        self,
+        method: str,
+        url: str,
+        *,
+        max_wait: float = MAX_RETRY_AFTER_SECONDS,
+        **kwargs: object,
+    ) -> httpx.Response:
+        r = await self._http.request(method, url, **kwargs)
+        if r.status_code == 304:
+            return r
+        try:
             r.raise_for_status()
-            payload = r.json()
-            self._token = payload["access_token"]
-            # Refresh a bit earlier than exact expiry
-            self._token_expiry = datetime.now(timezone.utc) + timedelta(
-                seconds=int(payload.get("expires_in", 3600)) - 120
-            )
-
-            # Update refresh token if present in response
-            new_refresh_token = payload.get("refresh_token")
-            if new_refresh_token and new_refresh_token != self.settings.refresh_token:
-                self.settings.refresh_token = new_refresh_token
-                # Persist to .env if possible
-                try:
-                    set_key(str(ENV_FILE), "ALLEGRO_REFRESH_TOKEN", new_refresh_token)
-                    logger.info("_ensure_token: Updated refresh token in .env file")
-                except Exception as e:
+        except httpx.HTTPStatusError:
+            if r.status_code in RATE_LIMIT_STATUSES:
+                # Honour the server's hint before the error reaches the poll
+                # loop, so its own backoff starts after the rate-limit window.
+                delay = _retry_delay(r, max_wait)
+                if delay:
                     logger.warning(
-                        f"_ensure_token: Failed to update refresh token in .env: {e}"
+                        "_request: %s %s returned %d, waiting %.0fs",
+                        method,
+                        url,
+                        r.status_code,
+                        delay,
                     )
+                    await asyncio.sleep(delay)
+            raise
+        return r
 
-            assert self._token, "Failed to obtain access token"
-            logger.info("_ensure_token: Obtained new access token")
-            return self._token
+    @staticmethod
+    def _json(r: httpx.Response) -> Dict[str, Any]:
+        return orjson.loads(r.content)
 
     async def _headers(self, use_beta: bool = False) -> Dict[str, str]:
-        token = await self._ensure_token()
-        content_type = (
-            "application/vnd.allegro.beta.v1+json"
-            if use_beta
-            else "application/vnd.allegro.public.v1+json"
-        )
-        return {
-            "Authorization": f"Bearer {token}",
-            "Accept": content_type,
-            "Content-Type": content_type,
-        }
+        await self._ensure_token()
+        base = self._hdr_beta if use_beta else self._hdr_public
+        return {**base, "Authorization": self._bearer}
 
     async def list_threads(self, limit: int = 20, offset: int = 0) -> Dict[str, Any]:
         headers = await self._headers()
-        url = f"{self.api_base}/messaging/threads?limit={limit}&offset={offset}"
-        async with httpx.AsyncClient(timeout=30) as client:
-            r = await client.get(url, headers=headers)
-            r.raise_for_status()
-            logger.info(
-                f"list_threads: Retrieved threads: {len(r.json().get('threads', []))}"
-            )
-            return r.json()
+        if self._threads_etag:
+            headers["If-None-Match"] = self._threads_etag
+        url = f"/messaging/threads?limit={limit}&offset={offset}"
+        r = await self._request("GET", url, headers=headers)
+        if r.status_code == 304:
+            logger.info("list_threads: Not modified")
+            return {"threads": []}
+        self._threads_etag = r.headers.get("ETag")
+        if not self._http_version_logged:
+            logger.info("list_threads: Using %s", r.http_version)
+            self._http_version_logged = True
+        payload = self._json(r)
+        logger.info(
+            "list_threads: Retrieved threads: %d", len(payload.get("threads", []))
+        )
+        return payload
+
+    def reset_threads_etag(self) -> None:
+        """Make the next list_threads return the full listing again."""
+        self._threads_etag = None
 
     async def list_messages(
         self,
@@ -112,72 +274,72 @@ class AllegroClient:
         offset: int = 0,
     ) -> Dict[str, Any]:
         headers = await self._headers()
-        url = f"{self.api_base}/messaging/threads/{thread_id}/messages?\
-            limit={limit}&offset={offset}"
+        url = f"/messaging/threads/{thread_id}/messages"
+        params: Dict[str, Any] = {"limit": limit, "offset": offset}
         if after:
-            from urllib.parse import quote
+            params["after"] = after
 
-            url += f"&after={quote(after)}"  # encode safely
-
-        async with httpx.AsyncClient(timeout=30) as client:
-            r = await client.get(url, headers=headers)
-            r.raise_for_status()
-            logger.info(
-                f"list_messages: Retrieved messages in {thread_id}: \
-                    {len(r.json().get('messages', []))}"
-            )
-            return r.json()
+        r = await self._request("GET", url, headers=headers, params=params)
+        payload = self._json(r)
+        logger.info(
+            "list_messages: Retrieved messages in %s: %d",
+            thread_id,
+            len(payload.get("messages", [])),
+        )
+        return payload
 
     async def post_message(self, thread_id: str, text: str) -> Dict[str, Any]:
         headers = await self._headers()
-        url = f"{self.api_base}/messaging/threads/{thread_id}/messages"
-        logger.info(f"post_message: Posting message to {thread_id}: {text}")
-        async with httpx.AsyncClient(timeout=30) as client:
-            r = await client.post(url, headers=headers, json={"text": text})
-            r.raise_for_status()
-            logger.info(f"post_message: Successfully posted message to {thread_id}")
-            return r.json()
+        url = f"/messaging/threads/{thread_id}/messages"
+        logger.info("post_message: Posting message to %s: %s", thread_id, text)
+        r = await self._request("POST", url, headers=headers, json={"text": text})
+        logger.info("post_message: Successfully posted message to %s", thread_id)
+        return self._json(r)
 
     async def list_issues(self, limit: int = 20, offset: int = 0) -> Dict[str, Any]:
         """List post-purchase issues/disputes."""
         headers = await self._headers(use_beta=True)
-        url = f"{self.api_base}/sale/issues?limit={limit}&offset={offset}"
-        async with httpx.AsyncClient(timeout=30) as client:
-            r = await client.get(url, headers=headers)
-            r.raise_for_status()
-            logger.info(
-                f"list_issues: Retrieved issues: {len(r.json().get('issues', []))}"
-            )
-            return r.json()
+        if self._issues_etag:
+            headers["If-None-Match"] = self._issues_etag
+        url = f"/sale/issues?limit={limit}&offset={offset}"
+        r = await self._request("GET", url, headers=headers)
+        if r.status_code == 304:
+            logger.info("list_issues: Not modified")
+            return {"issues": []}
+        self._issues_etag = r.headers.get("ETag")
+        payload = self._json(r)
+        logger.info("list_issues: Retrieved issues: %d", len(payload.get("issues", [])))
+        return payload
+
+    def reset_issues_etag(self) -> None:
+        """Make the next list_issues return the full listing again."""
+        self._issues_etag = None
 
     async def list_issue_messages(
         self, issue_id: str, limit: int = 20, offset: int = 0
     ) -> Dict[str, Any]:
         """List messages for a specific issue."""
         headers = await self._headers(use_beta=True)
-        url = (
-            f"{self.api_base}/sale/issues/{issue_id}/chat?limit={limit}&offset={offset}"
+        url = f"/sale/issues/{issue_id}/chat?limit={limit}&offset={offset}"
+        r = await self._request("GET", url, headers=headers)
+        payload = self._json(r)
+        logger.info(
+            "list_issue_messages: Retrieved messages for issue %s: %d",
+            issue_id,
+            len(payload.get("chat", [])),
         )
-        async with httpx.AsyncClient(timeout=30) as client:
-            r = await client.get(url, headers=headers)
-            r.raise_for_status()
-            message_count = len(r.json().get("chat", []))
-            logger.info(
-                f"list_issue_messages: Retrieved messages for issue {issue_id}: "
-                f"{message_count}"
-            )
-            return r.json()
+        return payload
 
     async def post_issue_message(self, issue_id: str, text: str) -> Dict[str, Any]:
         """Post a message to an issue."""
         headers = await self._headers(use_beta=True)
-        url = f"{self.api_base}/sale/issues/{issue_id}/message"
+        url = f"/sale/issues/{issue_id}/message"
         payload = {"text": text, "type": "REGULAR"}
-        logger.info(f"post_issue_message: Posting message to issue {issue_id}: {text}")
-        async with httpx.AsyncClient(timeout=30) as client:
-            r = await client.post(url, headers=headers, json=payload)
-            r.raise_for_status()
-            logger.info(
-                f"post_issue_message: Successfully posted message to issue {issue_id}"
-            )
-            return r.json()
+        logger.info(
+            "post_issue_message: Posting message to issue %s: %s", issue_id, text
+        )
+        r = await self._request("POST", url, headers=headers, json=payload)
+        logger.info(
+            "post_issue_message: Successfully posted message to issue %s", issue_id
+        )
+        return self._json(r)
@@ -1,5 +1,6 @@
 from __future__ import annotations
 
+import functools
 import os
 from zoneinfo import ZoneInfo
 
@@ -8,51 +9,39 @@ from pydantic import BaseModel, Field
 
 load_dotenv()
 
+# Environment is read once at import, after .env has been loaded
+_env = os.environ.copy()
+
 
 class Settings(BaseModel):
     # Allegro API
-    client_id: str = Field(default_factory=lambda: os.getenv("ALLEGRO_CLIENT_ID", ""))
-    client_secret: str = Field(
-        default_factory=lambda: os.getenv("ALLEGRO_CLIENT_SECRET", "")
-    )
-    refresh_token: str = Field(
-        default_factory=lambda: os.getenv("ALLEGRO_REFRESH_TOKEN", "")
-    )
+    client_id: str = Field(default=_env.get("ALLEGRO_CLIENT_ID", ""))
+    client_secret: str = Field(default=_env.get("ALLEGRO_CLIENT_SECRET", ""))
+    refresh_token: str = Field(default=_env.get("ALLEGRO_REFRESH_TOKEN", ""))
 
-    environment: str = Field(
-        default_factory=lambda: os.getenv("ALLEGRO_ENV", "production")
-    )
+    environment: str = Field(default=_env.get("ALLEGRO_ENV", "production"))
 
     # Polling
-    poll_interval_seconds: int = Field(
-        default_factory=lambda: int(os.getenv("POLL_INTERVAL", "60"))
-    )
-    max_threads_per_poll: int = Field(
-        default_factory=lambda: int(os.getenv("MAX_THREADS", "5"))
-    )
-    max_issues_per_poll: int = Field(
-        default_factory=lambda: int(os.getenv("MAX_ISSUES", "5"))
-    )
+    poll_interval_seconds: int = Field(default=int(_env.get("POLL_INTERVAL", "60")))
+    max_threads_per_poll: int = Field(default=int(_env.get("MAX_THREADS", "5")))
+    max_issues_per_poll: int = Field(default=int(_env.get("MAX_ISSUES", "5")))
+    max_concurrent: int = Field(default=int(_env.get("MAX_CONCURRENT", "5")))
 
     # Business rules
-    tz: ZoneInfo = Field(default=ZoneInfo(os.getenv("BUSINESS_TZ", "Europe/Warsaw")))
-    work_hours_start: int = Field(
-        default_factory=lambda: int(os.getenv("WORK_START_H", "9"))
-    )
-    work_hours_end: int = Field(
-        default_factory=lambda: int(os.getenv("WORK_END_H", "17"))
-    )
+    tz: ZoneInfo = Field(default=ZoneInfo(_env.get("BUSINESS_TZ", "Europe/Warsaw")))
+    work_hours_start: int = Field(default=int(_env.get("WORK_START_H", "9")))
+    work_hours_end: int = Field(default=int(_env.get("WORK_END_H", "17")))
 
     # Templates
     autoresponse_message: str = Field(
-        default_factory=lambda: os.getenv(
+        default=_env.get(
             "TEMPLATE_FIRST_CONTACT",
             "Dziękujemy za kontakt! Wkrótce wrócimy z odpowiedzią. \
                 Wiadomość automatyczna)",
         )
     )
     autoresponse_issue: str = Field(
-        default_factory=lambda: os.getenv(
+        default=_env.get(
             "TEMPLATE_ISSUE",
             "Dziękujemy za zgłoszenie problemu. Sprawdzimy sprawę i wkrótce się \
                 z Tobą skontaktujemy.",
@@ -61,15 +50,16 @@ class Settings(BaseModel):
 
     # Behavior switches
     reply_outside_working_hours: bool = Field(
-        default_factory=lambda: os.getenv("REPLY_AFTER_HOURS", "true").lower() == "true"
+        default=_env.get("REPLY_AFTER_HOURS", "true").lower() == "true"
     )
     reply_only_first_message: bool = Field(
-        default_factory=lambda: os.getenv("REPLY_ONLY_FIRST", "true").lower() == "true"
+        default=_env.get("REPLY_ONLY_FIRST", "true").lower() == "true"
     )
     process_issues: bool = Field(
-        default_factory=lambda: os.getenv("PROCESS_ISSUES", "true").lower() == "true"
+        default=_env.get("PROCESS_ISSUES", "true").lower() == "true"
     )
 
 
+@functools.lru_cache(maxsize=1)
 def get_settings() -> Settings:
     return Settings()
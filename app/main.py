@@ -2,14 +2,17 @@ from __future__ import annotations
 
 import asyncio
 import logging
+import random
+from collections import OrderedDict
 from datetime import datetime, timezone
-from typing import Optional
+from typing import Awaitable, Callable, Optional
 
+import ciso8601
 from fastapi import FastAPI
 
-from .allegro import AllegroClient
+from .allegro import AllegroClient, is_rate_limited
 from .config import get_settings
-from .rules import decide_autoreply
+from .rules import MAX_MESSAGE_AGE, decide_autoreply
 
 
 def parse_timestamp(timestamp_str: Optional[str], fallback: datetime) -> datetime:
@@ -17,11 +20,20 @@ def parse_timestamp(timestamp_str: Optional[str], fallback: datetime) -> datetim
     if not timestamp_str:
         return fallback
     try:
-        return datetime.fromisoformat(timestamp_str.replace("Z", "+00:00"))
-    except (ValueError, AttributeError):
+        return ciso8601.parse_datetime(timestamp_str)
+    except (ValueError, TypeError):
         return fallback
 
 
+def _msg_ts(m: dict) -> str:
+    """Creation timestamp of a message, under whichever key Allegro used.
+
+    Pick the latest with max(reversed(...)) so ties resolve to the last message
+    in API order, as a stable sort would.
+    """
+    return m.get("createdAt") or m.get("created") or m.get("creationDate") or ""
+
+
 logging.basicConfig(
     level=logging.INFO,
     format="[%(asctime)s] [%(levelname)s] %(name)s: %(message)s",
@@ -34,34 +46,153 @@ settings = get_settings()
 app = FastAPI(title="Allegro Autoresponder")
 client = AllegroClient(settings)
 
+# caps in-flight per-thread/per-issue requests within a single poll
+sem = asyncio.Semaphore(settings.max_concurrent or 5)
+
+# last seen activity marker per thread/issue, so unchanged ones skip fetching
+SEEN_CACHE_SIZE = 1024
+thread_seen: OrderedDict[str, str] = OrderedDict()
+issue_seen: OrderedDict[str, str] = OrderedDict()
 
-# background task handle
+
+# cap for the exponential backoff between failing polls
+MAX_BACKOFF_SECONDS = 900
+
+# background task handles
 poll_task: Optional[asyncio.Task] = None
+token_task: Optional[asyncio.Task] = None
 
 
-async def poll_loop() -> None:
+async def token_loop() -> None:
+    # Refresh the access token ahead of expiry so polls never block on OAuth
+    while True:
+        try:
+            await client.refresh_access_token()
+        except Exception:
+            logger.exception("[token] refresh error")
+        await asyncio.sleep(client.token_refresh_delay())
+
+
+def _backoff_delay(attempt: int) -> float:
+    """Poll interval, doubled per consecutive failure and jittered by ±20%."""
     interval = settings.poll_interval_seconds
+    if attempt == 0:
+        return interval
+    delay = min(max(MAX_BACKOFF_SECONDS, interval), interval * 2**attempt)
+    # Never poll a failing API more often than a healthy one, even after jitter
+    return max(interval, delay * (1 + random.uniform(-0.2, 0.2)))
+
+
+def _log_poll_error(error: Exception) -> None:
+    # Rate limits were already logged per item; only note the backoff here
+    if is_rate_limited(error):
+        logger.warning("[poll] rate limited, backing off")
+    else:
+        logger.error("[poll] error: %s", error, exc_info=error)
+
+
+async def poll_loop() -> None:
+    attempt = 0
     while True:
         try:
             await process_once()
+            attempt = 0
         except Exception as e:
-            # log to stdout (Railway captures logs)
-            print(f"[poll] error: {e}")
-        await asyncio.sleep(interval)
+            _log_poll_error(e)
+            attempt += 1
+        await asyncio.sleep(_backoff_delay(attempt))
 
 
 async def process_once() -> None:
     now = datetime.now(timezone.utc)
+    cutoff = now - MAX_MESSAGE_AGE
 
-    # Process threads
-    await process_threads(now)
-
-    # Process issues/disputes
+    # Threads and issues hit independent endpoints, so fetch them concurrently
+    tasks = [process_threads(now, cutoff)]
     if settings.process_issues:
-        await process_issues(now)
+        tasks.append(process_issues(now, cutoff))
+
+    results = await asyncio.gather(*tasks, return_exceptions=True)
+    errors = [r for r in results if isinstance(r, Exception)]
+    # Log every failure so one branch doesn't mask the other; the first is
+    # re-raised so poll_loop backs off.
+    for error in errors[1:]:
+        _log_poll_error(error)
+    if errors:
+        raise errors[0]
+
+
+def _is_seen(cache: OrderedDict[str, str], key: str, marker: Optional[str]) -> bool:
+    if marker is None or cache.get(key) != marker:
+        return False
+    cache.move_to_end(key)
+    return True
+
+
+def _mark_seen(cache: OrderedDict[str, str], key: str, marker: Optional[str]) -> None:
+    if marker is None:
+        return
+    cache[key] = marker
+    cache.move_to_end(key)
+    if len(cache) > SEEN_CACHE_SIZE:
+        cache.popitem(last=False)
+
 
+def _thread_marker(th: dict) -> Optional[str]:
+    return th.get("lastMessageDateTime") or (th.get("lastMessage") or {}).get("id")
 
-async def process_threads(now: datetime) -> None:
+
+def _issue_marker(issue: dict, status: str) -> Optional[str]:
+    last_message = (issue.get("chat") or {}).get("lastMessage") or {}
+    ts = last_message.get("createdAt") or issue.get("updatedAt")
+    return f"{status}:{ts}" if ts else None
+
+
+async def _bounded(coro: Awaitable[None]) -> None:
+    async with sem:
+        await coro
+
+
+async def _gather_items(
+    kind: str,
+    items: list[dict],
+    handle: Callable[[dict], Awaitable[None]],
+    item_id: Callable[[dict], Optional[str]],
+    reset_etag: Callable[[], None],
+) -> None:
+    """Handle listed items concurrently and log each failure with its id.
+
+    Any failure resets the listing's ETag, because a 304 on the next poll would
+    hide the failed item. The first 429/503 is re-raised so poll_loop backs off.
+    """
+    results = await asyncio.gather(
+        *(_bounded(handle(item)) for item in items),
+        return_exceptions=True,
+    )
+    failed = False
+    rate_limited: Optional[Exception] = None
+    for item, result in zip(items, results, strict=True):
+        if isinstance(result, Exception):
+            failed = True
+            if is_rate_limited(result):
+                # No traceback: the poll loop reports the backoff once
+                logger.warning("[%s %s] rate limited: %s", kind, item_id(item), result)
+                rate_limited = rate_limited or result
+                continue
+            logger.error(
+                "[%s %s] processing error: %s",
+                kind,
+                item_id(item),
+                result,
+                exc_info=result,
+            )
+    if failed:
+        reset_etag()
+    if rate_limited:
+        raise rate_limited
+
+
+async def process_threads(now: datetime, cutoff: datetime) -> None:
     """Process messaging threads for ASK_QUESTION types."""
     threads_payload = await client.list_threads(
         limit=settings.max_threads_per_poll, offset=0
@@ -69,162 +200,190 @@ async def process_threads(now: datetime) -> None:
     threads = (
         threads_payload.get("threads", []) or threads_payload.get("items", []) or []
     )
-    logger.info(f"Fetched {len(threads)} threads")
-
-    for th in threads:
-        now = datetime.now(timezone.utc)
-        thread_id = th.get("id") or th.get("thread", {}).get("id")
-        if not thread_id:
-            continue
-
-        logger.info(f"[thread {thread_id}] fetching messages...")
-        msgs_payload = await client.list_messages(thread_id)
-        messages = (
-            msgs_payload.get("messages", []) or msgs_payload.get("items", []) or []
-        )
+    logger.info("Fetched %d threads", len(threads))
+
+    await _gather_items(
+        "thread",
+        threads,
+        lambda th: _handle_thread(th, now, cutoff),
+        _thread_id,
+        client.reset_threads_etag,
+    )
 
-        if not messages:
-            continue
 
-        # Sort by creation time ascending (if not already)
-        def _ts(m: dict) -> str:
-            return m.get("createdAt") or m.get("created") or m.get("creationDate") or ""
+def _thread_id(th: dict) -> Optional[str]:
+    return th.get("id") or th.get("thread", {}).get("id")
 
-        messages.sort(key=_ts)
 
-        # Check if the last message is from interlocutor (buyer)
-        last_message = messages[-1]
-        logger.info(f"[thread {thread_id}] last message: {last_message}")
-        is_from_interlocutor = last_message.get("author", {}).get(
-            "isInterlocutor", False
-        )
+async def _handle_thread(th: dict, now: datetime, cutoff: datetime) -> None:
+    thread_id = _thread_id(th)
+    if not thread_id:
+        return
 
-        is_ask_type = last_message.get("type", "") == "ASK_QUESTION"
+    marker = _thread_marker(th)
+    if _is_seen(thread_seen, thread_id, marker):
+        logger.info("[thread %s] no new activity, skipping", thread_id)
+        return
 
-        if not is_from_interlocutor:
-            logger.info(
-                f"[thread {thread_id}] last message not from interlocutor, skipping"
-            )
-            continue
-
-        if not is_ask_type:
-            logger.info(f"[thread {thread_id}] last message not ASK_QUESTION, skipping")
-            continue
-
-        msg_time = parse_timestamp(last_message.get("createdAt"), now)
-        decision = decide_autoreply(
-            now=now,
-            msg_time=msg_time,
-            settings=settings,
-            is_issue=False,
-        )
+    await _process_thread(thread_id, now, cutoff)
+    # Only reached when the thread was fully handled; failures retry next poll
+    _mark_seen(thread_seen, thread_id, marker)
+
+
+async def _process_thread(thread_id: str, now: datetime, cutoff: datetime) -> None:
+    logger.info("[thread %s] fetching messages...", thread_id)
+    # Allegro returns thread messages newest first; only the latest one matters
+    msgs_payload = await client.list_messages(thread_id, limit=1)
+    messages = msgs_payload.get("messages", []) or msgs_payload.get("items", []) or []
+
+    if not messages:
+        return
 
+    # Check if the latest message is from interlocutor (buyer)
+    last_message = max(reversed(messages), key=_msg_ts)
+    logger.info("[thread %s] last message: %s", thread_id, last_message)
+    is_from_interlocutor = last_message.get("author", {}).get("isInterlocutor", False)
+
+    is_ask_type = last_message.get("type", "") == "ASK_QUESTION"
+
+    if not is_from_interlocutor:
         logger.info(
-            f"[thread {thread_id}] decision: {decision.reason} "
-            f"should_reply={decision.should_reply}"
+            "[thread %s] last message not from interlocutor, skipping", thread_id
         )
+        return
+
+    if not is_ask_type:
+        logger.info("[thread %s] last message not ASK_QUESTION, skipping", thread_id)
+        return
+
+    msg_time = parse_timestamp(last_message.get("createdAt"), now)
+    decision = decide_autoreply(
+        cutoff=cutoff,
+        msg_time=msg_time,
+        settings=settings,
+        is_issue=False,
+    )
 
-        # Post reply if needed
-        if decision.should_reply and decision.message:
-            try:
-                await client.post_message(thread_id, decision.message)
-                logger.info(f"[thread {thread_id}] replied successfully")
-            except Exception as e:
-                print(f"[thread {thread_id}] post_message error: {e}")
+    logger.info(
+        "[thread %s] decision: %s should_reply=%s",
+        thread_id,
+        decision.reason,
+        decision.should_reply,
+    )
+
+    # Post reply if needed
+    if decision.should_reply and decision.message:
+        await client.post_message(thread_id, decision.message)
+        logger.info("[thread %s] replied successfully", thread_id)
 
 
-async def process_issues(now: datetime) -> None:
+async def process_issues(now: datetime, cutoff: datetime) -> None:
     """Process post-purchase issues/disputes."""
     issues_payload = await client.list_issues(
         limit=settings.max_issues_per_poll, offset=0
     )
     issues = issues_payload.get("issues", []) or []
-    logger.info(f"Fetched {len(issues)} issues")
+    logger.info("Fetched %d issues", len(issues))
+
+    await _gather_items(
+        "issue",
+        issues,
+        lambda issue: _handle_issue(issue, now, cutoff),
+        lambda issue: issue.get("id"),
+        client.reset_issues_etag,
+    )
 
-    for issue in issues:
-        now = datetime.now(timezone.utc)
-        issue_id = issue.get("id")
-        if not issue_id:
-            continue
 
-        logger.info(f"[issue {issue_id}]: {issue}")
-        # Check if issue was just started (has status that indicates new issue)
-        current_state = issue.get("currentState")
-        status = current_state.get("status") if current_state else None
-        if status != "DISPUTE_ONGOING":
-            logger.info(f"[issue {issue_id}] status is {status}, skipping")
-            continue
+async def _handle_issue(issue: dict, now: datetime, cutoff: datetime) -> None:
+    issue_id = issue.get("id")
+    if not issue_id:
+        return
 
-        logger.info(f"[issue {issue_id}] processing issue with status: {status}")
+    logger.info("[issue %s]: %s", issue_id, issue)
+    # Check if issue was just started (has status that indicates new issue)
+    current_state = issue.get("currentState")
+    status = current_state.get("status") if current_state else None
+    if status != "DISPUTE_ONGOING":
+        logger.info("[issue %s] status is %s, skipping", issue_id, status)
+        return
 
-        try:
-            msgs_payload = await client.list_issue_messages(issue_id)
-            messages = msgs_payload.get("chat", []) or []
+    marker = _issue_marker(issue, status)
+    if _is_seen(issue_seen, issue_id, marker):
+        logger.info("[issue %s] no new activity, skipping", issue_id)
+        return
 
-            if not messages:
-                continue
+    logger.info("[issue %s] processing issue with status: %s", issue_id, status)
+    await _process_issue(issue_id, now, cutoff)
+    # Only reached when the issue was fully handled; failures retry next poll
+    _mark_seen(issue_seen, issue_id, marker)
 
-            logger.info(f"[issue {issue_id}] fetched {len(messages)} messages")
 
-            if len(messages) > 2:
-                logger.info(f"[issue {issue_id}] more than 2 messages, skipping")
-                continue
+async def _process_issue(issue_id: str, now: datetime, cutoff: datetime) -> None:
+    # Issues with more than 2 messages are skipped, so 3 is enough to tell
+    msgs_payload = await client.list_issue_messages(issue_id, limit=3)
+    messages = msgs_payload.get("chat", []) or []
 
-            # logger.info(f"[issue {issue_id}] messages: {messages}")
+    if not messages:
+        return
 
-            # Sort by creation time ascending
-            def _ts(m: dict) -> str:
-                return (
-                    m.get("createdAt")
-                    or m.get("created")
-                    or m.get("creationDate")
-                    or ""
-                )
+    logger.info("[issue %s] fetched %d messages", issue_id, len(messages))
 
-            messages.sort(key=_ts)
+    if len(messages) > 2:
+        logger.info("[issue %s] more than 2 messages, skipping", issue_id)
+        return
 
-            # Check if the last message is from buyer
-            last_message = messages[-1]
-            is_from_buyer = last_message.get("author", {}).get("role") == "BUYER"
+    # logger.info("[issue %s] messages: %s", issue_id, messages)
 
-            if not is_from_buyer:
-                logger.info(f"[issue {issue_id}] last message not from buyer, skipping")
-                continue
+    # Check if the latest message is from buyer
+    last_message = max(reversed(messages), key=_msg_ts)
+    is_from_buyer = last_message.get("author", {}).get("role") == "BUYER"
 
-            msg_time = parse_timestamp(last_message.get("createdAt"), now)
+    if not is_from_buyer:
+        logger.info("[issue %s] last message not from buyer, skipping", issue_id)
+        return
 
-            decision = decide_autoreply(
-                now=now,
-                msg_time=msg_time,
-                settings=settings,
-                is_issue=True,
-            )
+    msg_time = parse_timestamp(last_message.get("createdAt"), now)
 
-            logger.info(
-                f"[issue {issue_id}] decision: {decision.reason} "
-                f"should_reply={decision.should_reply}"
-            )
+    decision = decide_autoreply(
+        cutoff=cutoff,
+        msg_time=msg_time,
+        settings=settings,
+        is_issue=True,
+    )
 
-            # Post reply if needed
-            if decision.should_reply and decision.message:
-                try:
-                    await client.post_issue_message(issue_id, decision.message)
-                    logger.info(f"[issue {issue_id}] replied successfully")
-                except Exception as e:
-                    print(f"[issue {issue_id}] post_issue_message error: {e}")
+    logger.info(
+        "[issue %s] decision: %s should_reply=%s",
+        issue_id,
+        decision.reason,
+        decision.should_reply,
+    )
 
-        except Exception as e:
-            print(f"[issue {issue_id}] processing error: {e}")
+    # Post reply if needed
+    if decision.should_reply and decision.message:
+        await client.post_issue_message(issue_id, decision.message)
+        logger.info("[issue %s] replied successfully", issue_id)
 
 
 @app.on_event("startup")
 async def on_startup() -> None:
     logger.info("Starting up...")
-    global poll_task
-    # Start background polling
+    global poll_task, token_task
+    # Start background token refresh and polling
+    token_task = asyncio.create_task(token_loop())
     poll_task = asyncio.create_task(poll_loop())
 
 
+@app.on_event("shutdown")
+async def on_shutdown() -> None:
+    logger.info("Shutting down...")
+    tasks = [task for task in (poll_task, token_task) if task]
+    for task in tasks:
+        task.cancel()
+    # Let in-flight requests unwind before the shared client is closed
+    await asyncio.gather(*tasks, return_exceptions=True)
+    await client.aclose()
+
+
 @app.get("/")
 async def root() -> dict:
     return {
@@ -1,18 +1,20 @@
 from __future__ import annotations
 
+from dataclasses import dataclass
 from datetime import datetime, timedelta
 from typing import Optional
 
 from .config import Settings
 
+# messages older than this are not auto-replied to
+MAX_MESSAGE_AGE = timedelta(minutes=10)
 
+
+@dataclass(frozen=True, slots=True)
 class Decision:
-    def __init__(
-        self, should_reply: bool, message: Optional[str] = None, reason: str = ""
-    ) -> None:
-        self.should_reply = should_reply
-        self.message = message
-        self.reason = reason
+    should_reply: bool
+    message: Optional[str] = None
+    reason: str = ""
 
 
 def is_working_time(now: datetime, settings: Settings) -> bool:
@@ -22,12 +24,12 @@ def is_working_time(now: datetime, settings: Settings) -> bool:
 
 def decide_autoreply(
     *,
-    now: datetime,
+    cutoff: datetime,
     msg_time: datetime,
     settings: Settings,
     is_issue: bool = False,
 ) -> Decision:
-    if now - msg_time > timedelta(minutes=10):
+    if msg_time < cutoff:
         return Decision(False, reason="message too old")
     if is_issue:
         return Decision(True, settings.autoresponse_issue, reason="issue")
@@ -2,7 +2,6 @@ import base64
 import hashlib
 import os
 import secrets
-import string
 
 import httpx
 from dotenv import load_dotenv
@@ -17,14 +16,14 @@ TOKEN_URL = "https://allegro.pl/auth/oauth/token"
 
 
 def generate_code_verifier() -> str:
-    code_verifier = "".join((secrets.choice(string.ascii_letters) for i in range(40)))
+    # 30 random bytes encode to 40 URL-safe characters
+    code_verifier = secrets.token_urlsafe(30)
     return code_verifier
 
 
 def generate_code_challenge(code_verifier: str) -> str:
     hashed = hashlib.sha256(code_verifier.encode("utf-8")).digest()
-    base64_encoded = base64.urlsafe_b64encode(hashed).decode("utf-8")
-    code_challenge = base64_encoded.replace("=", "")
+    code_challenge = base64.urlsafe_b64encode(hashed).rstrip(b"=").decode("ascii")
     return code_challenge
 
 